@@ -17,18 +17,44 @@
 
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
 from datetime import datetime
+from dataclasses import dataclass
+from array import array
 import threading
+import queue
 import time
+import orjson
+import msgpack
+from pydantic import BaseModel, ValidationError
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that parses and serializes through orjson"""
+
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj, default=self.default).decode()
+        except orjson.JSONEncodeError:
+            # orjson rejects integers outside the 64-bit range; the stdlib encoder does not
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Short-lived cache for GET endpoints polled by dashboards and monitors
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 1})
 
 # ============================================================================
 # In-Memory Storage and System Configuration
 # ============================================================================
 
-sensor_data = []  # List to store recent sensor readings
 device_controls = {
     'temperature_override': None,
     'humidity_override': None,
@@ -40,27 +66,216 @@ device_controls = {
 }
 
 system_config = {
-    'update_interval': 1,  # Data update interval in seconds
-    'max_records': 100,    # Maximum number of stored sensor records
-    'auto_cleanup': True   # Whether to remove old data automatically
+    'update_interval': 1,      # Data update interval in seconds
+    'max_records': 100,        # Maximum number of stored sensor records
+    'auto_cleanup': True,      # Whether to remove old data automatically
+    'ingest_batch_size': 256,  # Maximum readings stored per batch
+    'ingest_wait': 0.05        # Seconds to wait for a batch to fill up
 }
 
+
+class SensorPayload(BaseModel):
+    """Sensor data sent by the ESP32 to POST /data"""
+    temperature: float
+    humidity: float
+    gas_level: int
+    motion_detected: bool
+    device_id: str | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class Reading:
+    """Stored sensor reading with control overrides and flags applied"""
+    temperature: float
+    humidity: float
+    gas_level: int
+    motion_detected: bool
+    device_id: str | None
+    timestamp: str
+    lights: bool
+    alarm: bool
+    simulation_mode: bool
+
+
+# Latest sensor reading per device_id, ordered from oldest to most recent.
+# With auto cleanup enabled the oldest device is evicted on insert, so no
+# background thread is needed.
+sensor_data = {}
+
+# Sensor fields paired with the control that overrides them
+_OVERRIDE_MAP = (
+    ('temperature', 'temperature_override'),
+    ('humidity', 'humidity_override'),
+    ('gas_level', 'gas_override'),
+    ('motion_detected', 'motion_override')
+)
+
+# Guards sensor_data and device_controls across threaded workers
+_state_lock = threading.RLock()
+
+# Number of controls currently set to something other than None/False
+_active_controls = 0
+
+# Encoded GET /data payload (without timestamp), rebuilt after any change
+_all_data_cache = None
+
+# Readings accepted by POST /data and waiting to be stored
+_ingest_q = queue.SimpleQueue()
+
+# Ring buffers with the numeric fields of the last 'max_records' readings,
+# one typed array per field so aggregates run over contiguous values
+_temperature_history = array('d', [0.0]) * system_config['max_records']
+_humidity_history = array('d', [0.0]) * system_config['max_records']
+_gas_history = array('d', [0.0]) * system_config['max_records']
+_motion_history = array('b', [0]) * system_config['max_records']
+_history_head = 0
+_history_count = 0
+
 # ============================================================================
-# Background Cleanup Thread
+# Background Ingestion Thread
 # ============================================================================
 
-def cleanup_old_data():
+def _store_readings(batch):
+    """
+    Applies control overrides to a batch of readings and stores them,
+    keeping only the latest reading per device. Every reading is added
+    to the numeric history.
+    """
+    global _all_data_cache
+
+    # A reading without device_id replaces everything received before it
+    start = 0
+    for i, data in enumerate(batch):
+        if 'device_id' not in data:
+            start = i
+    reset = 'device_id' not in batch[start]
+
+    with _state_lock:
+        # Build every reading and add it to the history, and coalesce the ones
+        # after the last reset to the latest reading of each device. Readings
+        # that fail are skipped instead of dropping the whole batch.
+        latest = {}
+        for i, data in enumerate(batch):
+            try:
+                device_id = data.get('device_id')
+
+                # Apply control overrides
+                for key, override_key in _OVERRIDE_MAP:
+                    value = device_controls[override_key]
+                    if value is not None:
+                        data[key] = value
+
+                reading = Reading(
+                    temperature=data['temperature'],
+                    humidity=data['humidity'],
+                    gas_level=data['gas_level'],
+                    motion_detected=data['motion_detected'],
+                    device_id=device_id,
+                    timestamp=data['timestamp'],
+                    lights=device_controls['lights'],
+                    alarm=device_controls['alarm'],
+                    simulation_mode=device_controls['simulation_mode']
+                )
+                if i >= start:
+                    latest.pop(device_id, None)
+                    latest[device_id] = reading
+            except Exception as e:
+                app.logger.error('Dropped sensor reading: %s', e)
+                continue
+            _record_history(reading)
+
+        # Replace existing data for the same devices, moving them to the end
+        if reset:
+            sensor_data.clear()
+        for device_id, reading in latest.items():
+            sensor_data.pop(device_id, None)
+            sensor_data[device_id] = reading
+
+        if system_config['auto_cleanup']:
+            while len(sensor_data) > system_config['max_records']:
+                del sensor_data[next(iter(sensor_data))]
+
+        _all_data_cache = None
+
+
+def _record_history(reading):
+    """Writes a reading into the numeric history buffers (caller holds _state_lock)"""
+    global _history_head, _history_count
+    try:
+        temperature = float(reading.temperature)
+        humidity = float(reading.humidity)
+        gas_level = float(reading.gas_level)
+    except (TypeError, ValueError, OverflowError):
+        return  # Non-numeric readings are stored but left out of the history
+
+    i = _history_head
+    _temperature_history[i] = temperature
+    _humidity_history[i] = humidity
+    _gas_history[i] = gas_level
+    _motion_history[i] = bool(reading.motion_detected)
+    _history_head = (i + 1) % len(_temperature_history)
+    _history_count = min(_history_count + 1, len(_temperature_history))
+
+
+def _latest_reading():
+    """Returns the most recently stored reading (caller holds _state_lock)"""
+    return next(reversed(sensor_data.values())) if sensor_data else None
+
+
+def ingest_sensor_data():
     """
-    Background task that periodically removes old sensor records 
-    to keep the list within 'max_records' limit.
+    Background task that drains queued readings and stores them in batches
+    of up to 'ingest_batch_size', waiting at most 'ingest_wait' seconds.
     """
     while True:
-        if len(sensor_data) > system_config['max_records']:
-            sensor_data.pop(0)  # Remove oldest record
-        time.sleep(60)
+        batch = [_ingest_q.get()]
+        deadline = time.monotonic() + system_config['ingest_wait']
+        while len(batch) < system_config['ingest_batch_size']:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_ingest_q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            _store_readings(batch)
+        except Exception as e:
+            app.logger.error('Failed to store sensor readings: %s', e)
 
-cleanup_thread = threading.Thread(target=cleanup_old_data, daemon=True)
-cleanup_thread.start()
+ingest_thread = threading.Thread(target=ingest_sensor_data, daemon=True)
+ingest_thread.start()
+
+# ============================================================================
+# Request Hooks and Response Helpers
+# ============================================================================
+
+@app.before_request
+def stamp_request_time():
+    """Formats the current UTC time once so handlers can reuse it"""
+    g.now_iso = datetime.utcnow().isoformat()
+
+
+def encode_json(obj):
+    """Serializes to JSON bytes with orjson, falling back to Flask's encoder"""
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        # orjson rejects integers outside the 64-bit range; the stdlib encoder does not
+        return app.json.dumps(obj).encode()
+
+
+def ojson(obj, status=200):
+    """Builds a JSON response serialized with orjson instead of jsonify"""
+    return app.response_class(encode_json(obj), status=status, mimetype='application/json')
+
+
+def msgpack_or_json(obj, status=200):
+    """Builds a msgpack response when the client accepts it, JSON otherwise"""
+    best = request.accept_mimetypes.best_match(['application/json', 'application/msgpack'])
+    if best == 'application/msgpack':
+        return app.response_class(msgpack.packb(obj), status=status, mimetype='application/msgpack')
+    return ojson(obj, status)
 
 # ============================================================================
 # Core Endpoints
@@ -75,137 +290,178 @@ def index():
 @app.route('/data', methods=['POST'])
 def receive_data():
     """
-    Receives sensor data from ESP32.
-    Supports overriding sensor values via remote controls.
+    Receives sensor data from ESP32 as JSON or msgpack.
+    Readings are queued and stored in batches; control overrides are
+    applied when the batch is stored.
     """
     try:
-        data = request.get_json()
-
-        # Ensure required fields are present
-        required_fields = ['temperature', 'humidity', 'gas_level', 'motion_detected']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-
-        # Apply control overrides
-        for key in ['temperature', 'humidity', 'gas_level', 'motion_detected']:
-            override_key = f"{key.split('_')[0]}_override"
-            if device_controls[override_key] is not None:
-                data[key] = device_controls[override_key]
-
-        # Add timestamp and control flags
-        data.update({
-            'timestamp': datetime.utcnow().isoformat(),
-            'lights': device_controls['lights'],
-            'alarm': device_controls['alarm'],
-            'simulation_mode': device_controls['simulation_mode']
-        })
-
-        # Replace existing data for the same device or keep only the latest
-        if 'device_id' in data:
-            sensor_data[:] = [d for d in sensor_data if d.get('device_id') != data['device_id']]
+        if request.mimetype == 'application/msgpack':
+            try:
+                body = msgpack.unpackb(request.get_data(), raw=False)
+            except ValueError:
+                return msgpack_or_json({'error': 'Invalid msgpack body'}, 400)
         else:
-            sensor_data.clear()
-
-        sensor_data.append(data)
+            body = request.get_json()
 
-        return jsonify({
-            'status': 'ok',
-            'data': data,
-            'controls': device_controls.copy(),
-            'timestamp': datetime.utcnow().isoformat()
-        }), 200
+        # Ensure required fields are present and have the expected types
+        try:
+            payload = SensorPayload.model_validate(body)
+        except ValidationError as e:
+            error = e.errors()[0]
+            field = '.'.join(str(part) for part in error['loc'])
+            if error['type'] == 'missing':
+                return msgpack_or_json({'error': f'Missing required field: {field}'}, 400)
+            if not field:
+                return msgpack_or_json({'error': f'Invalid payload: {error["msg"]}'}, 400)
+            return msgpack_or_json({'error': f'Invalid field {field}: {error["msg"]}'}, 400)
+
+        # Leave device_id out when it was not sent so the reading replaces all data
+        data = payload.model_dump(exclude_unset=True)
+
+        # Stamp the reading with its arrival time and hand it to the ingest thread
+        data['timestamp'] = g.now_iso
+        _ingest_q.put(data)
+
+        with _state_lock:
+            controls = dict(device_controls)
+
+        return msgpack_or_json({
+            'status': 'accepted',
+            'controls': controls,
+            'timestamp': g.now_iso
+        }, 202)
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return msgpack_or_json({'error': str(e)}, 500)
 
 
 @app.route('/data', methods=['GET'])
 def get_all_data():
     """Returns all sensor data (most recent first)"""
-    return jsonify({
-        'data': sensor_data[::-1],
-        'total_records': len(sensor_data),
-        'controls': device_controls,
-        'timestamp': datetime.utcnow().isoformat()
-    }), 200
+    global _all_data_cache
+    with _state_lock:
+        if _all_data_cache is None:
+            _all_data_cache = encode_json({
+                'data': list(reversed(sensor_data.values())),
+                'total_records': len(sensor_data),
+                'controls': device_controls
+            })
+        payload = _all_data_cache
+
+    # Splice the per-request timestamp into the cached object
+    body = payload[:-1] + b',"timestamp":' + orjson.dumps(g.now_iso) + b'}'
+    return app.response_class(body, mimetype='application/json')
 
 
 @app.route('/latest', methods=['GET'])
 def get_latest_data():
     """Returns the most recent sensor reading"""
-    if sensor_data:
-        return jsonify({
-            'data': sensor_data[-1],
-            'controls': device_controls,
-            'timestamp': datetime.utcnow().isoformat()
-        }), 200
-    return jsonify({'message': 'No data available'}), 404
+    with _state_lock:
+        latest = _latest_reading()
+        controls = dict(device_controls)
+    if latest is not None:
+        return ojson({
+            'data': latest,
+            'controls': controls,
+            'timestamp': g.now_iso
+        })
+    return ojson({'message': 'No data available'}, 404)
 
 # ============================================================================
 # Remote Control Endpoints
 # ============================================================================
 
-def create_control_endpoint(key, description, cast_type):
-    """
-    Factory to create reusable control endpoints with unique names.
-    """
-    def control():
-        try:
-            data = request.get_json()
-            override_key = f"{key}_override" if key in ['temperature', 'humidity', 'gas', 'motion'] else key
-            if 'value' in data:
-                device_controls[override_key] = cast_type(data['value'])
-                msg = f'{description} set to {data["value"]}'
-            else:
-                device_controls[override_key] = None
-                msg = f'{description} override disabled'
-            return jsonify({
-                'status': 'ok',
-                'message': msg,
-                'current_override': device_controls.get(override_key)
-            }), 200
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
+def invalidate_control_views():
+    """Drops cached GET responses that report the current controls"""
+    global _all_data_cache
+    with _state_lock:
+        _all_data_cache = None
+    cache.delete_many('view//controls', 'view//status')
+
+
+# Integer range that orjson can serialize (signed and unsigned 64-bit)
+_INT_RANGE = (-2 ** 63, 2 ** 64 - 1)
+
+# Control name -> (description, value type, key in device_controls)
+_CONTROLS = {
+    'temperature': ('Temperature', float, 'temperature_override'),
+    'humidity': ('Humidity', float, 'humidity_override'),
+    'gas': ('Gas level', int, 'gas_override'),
+    'motion': ('Motion detection', bool, 'motion_override'),
+    'lights': ('Lights', bool, 'lights'),
+    'alarm': ('Alarm', bool, 'alarm'),
+    'simulation_mode': ('Simulation mode', bool, 'simulation_mode')
+}
 
-    # Assign a unique name to the control function
-    control.__name__ = f'control_{key}'
 
-    # Register the control endpoint with Flask
-    app.route(f'/control/{key}', methods=['POST'], endpoint=f'control_{key}')(control)
+def _is_active(value):
+    """Whether a control value counts as an active override or flag"""
+    return value is not None and value is not False
 
-# Generate control endpoints
-create_control_endpoint('temperature', 'Temperature', float)
-create_control_endpoint('humidity', 'Humidity', float)
-create_control_endpoint('gas', 'Gas level', int)
-create_control_endpoint('motion', 'Motion detection', bool)
-create_control_endpoint('lights', 'Lights', bool)
-create_control_endpoint('alarm', 'Alarm', bool)
-create_control_endpoint('simulation_mode', 'Simulation mode', bool)
+
+@app.route('/control/<key>', methods=['POST'])
+def control(key):
+    """Sets or clears a control override or device flag"""
+    global _active_controls
+    config = _CONTROLS.get(key)
+    if config is None:
+        return jsonify({'error': f'Unknown control: {key}'}), 404
+    description, cast_type, override_key = config
+
+    # Parse and validate the new value before any state is changed
+    try:
+        data = request.get_json()
+        value = cast_type(data['value']) if 'value' in data else None
+        if 'value' in data:
+            msg = f'{description} set to {data["value"]}'
+        else:
+            msg = f'{description} override disabled'
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    if cast_type is int and value is not None and not _INT_RANGE[0] <= value <= _INT_RANGE[1]:
+        return jsonify({'error': f'{description} value out of range: {data["value"]}'}), 400
+
+    with _state_lock:
+        _active_controls += _is_active(value) - _is_active(device_controls[override_key])
+        device_controls[override_key] = value
+    invalidate_control_views()
+    return jsonify({
+        'status': 'ok',
+        'message': msg,
+        'current_override': value
+    }), 200
 
 
 @app.route('/controls', methods=['GET'])
+@cache.cached(timeout=1)
 def get_all_controls():
     """Returns the current status of all controls"""
+    with _state_lock:
+        controls = dict(device_controls)
     return jsonify({
-        'controls': device_controls,
-        'timestamp': datetime.utcnow().isoformat()
+        'controls': controls,
+        'timestamp': g.now_iso
     }), 200
 
 
 @app.route('/controls/reset', methods=['POST'])
 def reset_all_controls():
     """Resets all control overrides to default values"""
-    global device_controls
-    device_controls = {
-        'temperature_override': None,
-        'humidity_override': None,
-        'gas_override': None,
-        'motion_override': None,
-        'lights': False,
-        'alarm': False,
-        'simulation_mode': False
-    }
+    global _active_controls
+
+    # Reset in place so every reader keeps seeing the same dict
+    with _state_lock:
+        _active_controls = 0
+        device_controls.update({
+            'temperature_override': None,
+            'humidity_override': None,
+            'gas_override': None,
+            'motion_override': None,
+            'lights': False,
+            'alarm': False,
+            'simulation_mode': False
+        })
+    invalidate_control_views()
     return jsonify({
         'status': 'ok',
         'message': 'All controls have been reset'
@@ -216,51 +472,101 @@ def reset_all_controls():
 # ============================================================================
 
 @app.route('/status', methods=['GET'])
+@cache.cached(timeout=1)
 def system_status():
     """Returns system status, configuration and metadata"""
+    with _state_lock:
+        records = len(sensor_data)
+        latest = _latest_reading()
     return jsonify({
         'system': 'OK',
         'version': '2.0',
-        'records': len(sensor_data),
-        'active_controls': sum(1 for v in device_controls.values() if v not in [None, False]),
-        'last_update': sensor_data[-1]['timestamp'] if sensor_data else None,
+        'records': records,
+        'active_controls': _active_controls,
+        'last_update': latest.timestamp if latest else None,
         'config': system_config,
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': g.now_iso
     }), 200
 
 
+@app.route('/stats', methods=['GET'])
+def sensor_stats():
+    """Returns aggregates over the numeric fields of recent readings"""
+    with _state_lock:
+        n = _history_count
+        temperature = _temperature_history[:n]
+        humidity = _humidity_history[:n]
+        gas = _gas_history[:n]
+        motion_events = sum(_motion_history[:n])
+    if not n:
+        return ojson({'message': 'No data available'}, 404)
+
+    def summary(values):
+        return {'avg': sum(values) / n, 'min': min(values), 'max': max(values)}
+
+    return ojson({
+        'samples': n,
+        'temperature': summary(temperature),
+        'humidity': summary(humidity),
+        'gas_level': summary(gas),
+        'motion_events': motion_events,
+        'timestamp': g.now_iso
+    })
+
+
 @app.route('/data/reset', methods=['POST'])
 def reset_sensor_data():
     """Deletes all sensor data from memory"""
-    sensor_data.clear()
+    global _all_data_cache, _history_head, _history_count
+    with _state_lock:
+        sensor_data.clear()
+        _all_data_cache = None
+        _history_head = _history_count = 0
     return jsonify({
         'status': 'sensor data cleared',
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': g.now_iso
     }), 200
 
 
 @app.route('/health', methods=['GET'])
+@cache.cached(timeout=1)
 def health_check():
     """Health check for uptime monitoring"""
-    return jsonify({
+    with _state_lock:
+        data_count = len(sensor_data)
+        latest = _latest_reading()
+    return ojson({
         'status': 'healthy',
         'uptime': 'running',
-        'data_count': len(sensor_data),
-        'last_update': sensor_data[-1]['timestamp'] if sensor_data else 'never',
-        'timestamp': datetime.utcnow().isoformat()
-    }), 200
+        'data_count': data_count,
+        'last_update': latest.timestamp if latest else 'never',
+        'timestamp': g.now_iso
+    })
 
 # ============================================================================
 # CORS Configuration
 # ============================================================================
 
-@app.after_request
-def add_cors_headers(response):
-    """Adds CORS headers to allow requests from any origin"""
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-    return response
+_CORS_HEADERS = [
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Headers', 'Content-Type,Authorization'),
+    ('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+]
+
+
+class CORSMiddleware:
+    """WSGI middleware that adds CORS headers to allow requests from any origin"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        def cors_start_response(status, headers, exc_info=None):
+            headers.extend(_CORS_HEADERS)
+            return start_response(status, headers, exc_info)
+        return self.wsgi_app(environ, cors_start_response)
+
+app.wsgi_app = CORSMiddleware(app.wsgi_app)
 
 # ============================================================================
 # Application Entry Point
@@ -276,5 +582,7 @@ if __name__ == '__main__':
     print("   GET  /controls          - Check current control status")
     print("   POST /controls/reset    - Reset all controls")
     print("   GET  /status            - System status")
+    print("   GET  /stats             - Sensor aggregates")
     print("   POST /data/reset        - Clear all sensor data")
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server only; in production run through gunicorn (see Procfile)
+    app.run(host='0.0.0.0', port=5000, threaded=True)